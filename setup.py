@@ -56,6 +56,9 @@ setup(
         'tomb_migrate.db_providers': [
             'postgresql = tomb_migrate.utils:PsycoDBContainer',
             'rethinkdb = tomb_migrate.utils:RethinkDBContainer',
+        ],
+        'tomb_migrate.revision_templates': [
+            'default = tomb_migrate.utils:DEFAULT_REVISION_TEMPLATE',
         ]
     },
 )
@@ -1,6 +1,8 @@
 import pytest
 import mock
 
+from collections import OrderedDict
+
 from click.testing import CliRunner
 
 
@@ -46,3 +48,214 @@ upgrade 00002
 Done upgrading
 '''
     assert expected == result.output
+
+
+def make_engine(version, canary=False):
+    engine = mock.Mock()
+    engine.parked = False
+    engine.settings = {'canary': canary}
+
+    def park(error):
+        engine.parked = True
+
+    engine.park.side_effect = park
+    engine.call.side_effect = lambda func, *args: func(*args)
+    engine.current_version.return_value = version
+    return engine
+
+
+def make_revision(version):
+    revision = mock.Mock()
+    revision.version = version
+    return revision
+
+
+@pytest.mark.unit
+def test_upgrade_engine_runs_pending_revisions():
+    from tomb_migrate.main import upgrade_engine
+
+    engine = make_engine(1)
+    revisions = [make_revision(1), make_revision(2), make_revision(3)]
+
+    timings = upgrade_engine(engine, revisions)
+
+    assert not revisions[0].upgrade.called
+    revisions[1].upgrade.assert_called_once_with(engine)
+    revisions[2].upgrade.assert_called_once_with(engine)
+    assert engine.update.call_args_list == [mock.call(2), mock.call(3)]
+    assert [r for r, seconds in timings] == revisions[1:]
+    assert engine.current_version.call_count == 1
+
+
+@pytest.mark.unit
+def test_upgrade_engine_parks_on_failure():
+    from tomb_migrate.main import upgrade_engine
+
+    engine = make_engine(0)
+    revisions = [make_revision(1), make_revision(2)]
+    error = Exception('boom')
+    revisions[0].upgrade.side_effect = error
+
+    timings = upgrade_engine(engine, revisions)
+
+    engine.park.assert_called_once_with(error)
+    assert not revisions[1].upgrade.called
+    assert timings == []
+
+
+@pytest.mark.unit
+def test_upgrade_engine_does_not_retry_marker_update():
+    from tomb_migrate.main import upgrade_engine
+    from tomb_migrate.utils import BaseDatabaseContainer
+
+    class FlakyError(Exception):
+        pass
+
+    class FlakyContainer(BaseDatabaseContainer):
+        transient_errors = (FlakyError,)
+        connect = mock.Mock()
+        current_version = mock.Mock(return_value=0)
+        update = mock.Mock(side_effect=[FlakyError(), None])
+        reset = mock.Mock()
+
+    engine = FlakyContainer('flaky', {
+        'type': 'flaky',
+        'host': '127.0.0.1',
+        'retries': 2,
+        'retry_backoff': 0,
+    })
+    revision = make_revision(1)
+
+    timings = upgrade_engine(engine, [revision])
+
+    revision.upgrade.assert_called_once_with(engine)
+    engine.update.assert_called_once_with(1)
+    assert not engine.reset.called
+    assert engine.parked
+    assert timings == []
+
+
+@pytest.mark.unit
+def test_upgrade_engine_parks_uninitialized_database():
+    from tomb_migrate.main import upgrade_engine
+    from tomb_migrate.utils import NotInitializedException
+
+    engine = make_engine(None)
+
+    assert upgrade_engine(engine, [make_revision(1)]) == []
+
+    error = engine.park.call_args[0][0]
+    assert isinstance(error, NotInitializedException)
+    assert 'tomb db init' in str(error)
+
+
+@pytest.mark.unit
+def test_rollout_stops_on_failed_canary():
+    from tomb_migrate.main import rollout
+
+    canary = make_engine(0, canary=True)
+    fleet = make_engine(0)
+    revision = make_revision(1)
+    revision.upgrade.side_effect = Exception('boom')
+
+    with pytest.raises(SystemExit):
+        rollout({'canary': canary, 'fleet': fleet}, [revision], 0, 1, None)
+
+    assert canary.parked
+    assert not fleet.open.called
+    assert not fleet.current_version.called
+
+
+@pytest.mark.unit
+@mock.patch('tomb_migrate.main.time')
+def test_rollout_stops_on_slow_canary(time):
+    from tomb_migrate.main import rollout
+
+    time.monotonic.side_effect = [0, 10]
+    canary = make_engine(0, canary=True)
+    fleet = make_engine(0)
+    revision = make_revision(1)
+
+    with pytest.raises(SystemExit):
+        rollout({'canary': canary, 'fleet': fleet}, [revision], 0, 1, 5)
+
+    revision.upgrade.assert_called_once_with(canary)
+    assert not fleet.open.called
+
+
+@pytest.mark.unit
+def test_rollout_canary_timeout_without_canaries():
+    from tomb_migrate.main import rollout
+
+    engine = make_engine(0)
+
+    with pytest.raises(SystemExit):
+        rollout({'fleet': engine}, [make_revision(1)], 0, 1, 5)
+
+    assert not engine.open.called
+
+
+@pytest.mark.unit
+@mock.patch('tomb_migrate.main.upgrade_wave')
+def test_rollout_upgrades_fleet_in_waves(upgrade_wave):
+    from tomb_migrate.main import rollout
+
+    upgrade_wave.return_value = []
+    canary = make_engine(0, canary=True)
+    fleet = [make_engine(0) for i in range(5)]
+    engines = OrderedDict([('canary', canary)])
+    engines.update(('fleet%s' % i, e) for i, e in enumerate(fleet))
+    upgrade_path = [make_revision(1)]
+
+    rollout(engines, upgrade_path, 2, 3, None)
+
+    assert upgrade_wave.call_args_list == [
+        mock.call([canary], upgrade_path, 3),
+        mock.call(fleet[0:2], upgrade_path, 3),
+        mock.call(fleet[2:4], upgrade_path, 3),
+        mock.call(fleet[4:5], upgrade_path, 3),
+    ]
+
+
+@pytest.mark.unit
+@mock.patch('tomb_migrate.main.upgrade_wave')
+def test_rollout_without_wave_size_upgrades_fleet_at_once(upgrade_wave):
+    from tomb_migrate.main import rollout
+
+    fleet = [make_engine(0) for i in range(3)]
+    engines = OrderedDict(('fleet%s' % i, e) for i, e in enumerate(fleet))
+    upgrade_path = [make_revision(1)]
+
+    rollout(engines, upgrade_path, 0, 1, None)
+
+    upgrade_wave.assert_called_once_with(fleet, upgrade_path, 1)
+
+
+@pytest.mark.unit
+def test_current_rss():
+    from tomb_migrate.main import current_rss
+
+    with mock.patch('tomb_migrate.main.open', create=True) as fopen:
+        fopen.return_value.__enter__.return_value.read.return_value = (
+            '1000 256 10 1 0 100 0'
+        )
+        with mock.patch('tomb_migrate.main.os.sysconf') as sysconf:
+            sysconf.return_value = 4096
+            assert current_rss() == 1.0
+
+
+@pytest.mark.unit
+def test_current_rss_without_proc():
+    from tomb_migrate.main import current_rss
+
+    with mock.patch('tomb_migrate.main.open', create=True) as fopen:
+        fopen.side_effect = OSError()
+        assert current_rss() is None
+
+
+@pytest.mark.unit
+def test_peak_rss_without_resource_module():
+    from tomb_migrate.main import peak_rss
+
+    with mock.patch.dict('sys.modules', {'resource': None}):
+        assert peak_rss() is None
@@ -122,3 +122,330 @@ def test_get_engines_from_settings_psyco():
     assert result['auth'].engine == container.engine
     assert result['auth'].settings == container.settings
     assert reg.called
+
+
+class FlakyError(Exception):
+    pass
+
+
+def make_flaky_container(**settings):
+    from tomb_migrate.utils import BaseDatabaseContainer
+
+    class FlakyContainer(BaseDatabaseContainer):
+        transient_errors = (FlakyError,)
+
+    settings.update({'type': 'flaky', 'host': '127.0.0.1'})
+    return FlakyContainer('flaky', settings)
+
+
+@pytest.mark.unit
+@mock.patch('tomb_migrate.utils.time')
+def test_call_retries_transient_errors(time):
+    container = make_flaky_container(retries=2, retry_backoff=1)
+    func = mock.Mock(side_effect=[FlakyError(), FlakyError(), 42])
+
+    assert container.call(func, 'foo') == 42
+    assert func.call_args_list == [call('foo')] * 3
+    assert time.sleep.call_args_list == [call(1), call(2)]
+    assert not container.parked
+
+
+@pytest.mark.unit
+@mock.patch('tomb_migrate.utils.time')
+def test_call_parks_database(time):
+    from tomb_migrate.utils import DatabaseParkedException
+
+    container = make_flaky_container(retries=1)
+    error = FlakyError()
+    func = mock.Mock(side_effect=error)
+
+    with pytest.raises(FlakyError):
+        container.call(func)
+
+    assert func.call_count == 2
+    assert container.parked
+    assert container.error is error
+
+    with pytest.raises(DatabaseParkedException):
+        container.call(func)
+
+    assert func.call_count == 2
+
+
+def make_psyco_container(rowcount):
+    from tomb_migrate.utils import PsycoDBContainer
+
+    conn = mock.MagicMock()
+    curs = conn.cursor.return_value.__enter__.return_value
+    curs.rowcount = rowcount
+
+    with mock.patch('tomb_migrate.utils.psycopg2.connect') as connect:
+        connect.return_value = conn
+        with mock.patch('tomb_migrate.utils.register_default_jsonb'):
+            container = PsycoDBContainer('auth', {
+                'type': 'postgresql',
+                'host': '127.0.0.1',
+                'database': 'sontek',
+            })
+            container.open()
+
+    return container, conn, curs
+
+
+@pytest.mark.unit
+def test_psyco_init_single_round_trip():
+    container, conn, curs = make_psyco_container(1)
+
+    container.init()
+
+    assert curs.execute.call_count == 1
+    assert conn.commit.called
+
+
+@pytest.mark.unit
+def test_psyco_init_already_initialized():
+    from tomb_migrate.utils import AlreadyInitializedException
+
+    container, conn, curs = make_psyco_container(0)
+
+    with pytest.raises(AlreadyInitializedException):
+        container.init()
+
+    assert curs.execute.call_count == 1
+
+
+def make_rethink_container(rethinkdb, inserted):
+    from tomb_migrate.utils import RethinkDBContainer
+
+    rethinkdb.branch.return_value.run.return_value = {'inserted': inserted}
+    container = RethinkDBContainer('user', {
+        'type': 'rethinkdb',
+        'host': '127.0.0.1',
+        'database': 'user',
+    })
+    container.open()
+    return container
+
+
+@pytest.mark.unit
+@mock.patch('tomb_migrate.utils.rethinkdb')
+def test_rethink_init_single_round_trip(rethinkdb):
+    from tomb_migrate.utils import MARKER_TABLE_NAME
+
+    container = make_rethink_container(rethinkdb, 1)
+    container.init()
+
+    marker = rethinkdb.table.return_value
+    missing = rethinkdb.table_list.return_value.contains.return_value.not_
+    assert rethinkdb.table_list.return_value.contains.call_args == call(
+        MARKER_TABLE_NAME
+    )
+    assert rethinkdb.branch.call_args == call(
+        missing.return_value,
+        rethinkdb.table_create.return_value.do.return_value,
+        marker.is_empty.return_value,
+        marker.insert.return_value,
+        {'inserted': 0},
+    )
+    rethinkdb.branch.return_value.run.assert_called_once_with(container.conn)
+
+
+@pytest.mark.unit
+@mock.patch('tomb_migrate.utils.rethinkdb')
+def test_rethink_init_already_initialized(rethinkdb):
+    from tomb_migrate.utils import AlreadyInitializedException
+
+    container = make_rethink_container(rethinkdb, 0)
+
+    with pytest.raises(AlreadyInitializedException):
+        container.init()
+
+
+@pytest.mark.unit
+def test_open_parks_unreachable_database():
+    container = make_flaky_container(retries=0)
+    error = FlakyError()
+    container.connect = mock.Mock(side_effect=error)
+
+    container.open()
+
+    assert container.parked
+    assert container.error is error
+    assert container.conn is None
+
+
+@pytest.mark.unit
+@mock.patch('tomb_migrate.utils.time')
+def test_throttle_adapts_to_lag(time):
+    from tomb_migrate.utils import Throttle
+
+    time.monotonic.side_effect = [0, 1, 2, 3, 4]
+    engine = mock.Mock()
+    engine.replication_lag.side_effect = [10, 0, 0, 0]
+    func = mock.Mock(side_effect=[100, 100, 100, 0])
+
+    throttle = Throttle(engine, max_lag=5, batch_size=100)
+    assert throttle.run(func) == 300
+
+    sizes = [c[0][0] for c in func.call_args_list]
+    assert sizes == [50, 75, 112, 168]
+    assert time.sleep.call_args_list == [call(0.1)]
+    assert throttle.rows_per_second == 75
+
+
+@pytest.mark.unit
+def test_create_new_revision_increments_version(tmpdir):
+    from tomb_migrate.utils import create_new_revision
+
+    tmpdir.join('00001_foo.py').write('')
+    tmpdir.join('00009_bar.py').write('')
+    tmpdir.mkdir('__pycache__')
+
+    path = create_new_revision(str(tmpdir), 'add users')
+
+    assert path == str(tmpdir.join('00010_add_users.py'))
+    assert 'def upgrade(engine)' in tmpdir.join('00010_add_users.py').read()
+
+
+@pytest.mark.unit
+def test_create_new_revision_refuses_to_clobber(tmpdir):
+    from tomb_migrate.utils import create_new_revision
+    from tomb_migrate.utils import RevisionExistsException
+
+    with mock.patch('tomb_migrate.utils.get_latest_version') as latest:
+        latest.return_value = (0, 4)
+        create_new_revision(str(tmpdir), 'foo')
+
+        with pytest.raises(RevisionExistsException):
+            create_new_revision(str(tmpdir), 'foo')
+
+    assert tmpdir.join('0001_foo.py').check()
+
+
+@pytest.mark.unit
+def test_iter_revisions_releases_modules():
+    import sys
+    from tomb_migrate.utils import Revision, iter_revisions
+
+    revisions = [
+        Revision('./tests/migrations/00001_foo.py'),
+        Revision('./tests/migrations/00002_bar.py'),
+    ]
+    assert all(r.module is None for r in revisions)
+
+    for revision in iter_revisions(revisions):
+        assert revision.filename in sys.modules
+        assert callable(revision.upgrade)
+
+    for revision in revisions:
+        assert revision.module is None
+        assert revision.filename not in sys.modules
+
+
+@pytest.mark.unit
+def test_get_upgrade_path_fails_on_broken_revision(tmpdir):
+    from tomb_migrate.utils import get_upgrade_path
+    from tomb_migrate.utils import RevisionLoadException
+
+    tmpdir.join('00001_foo.py').write('def upgrade(engine): pass\n')
+    tmpdir.join('00002_bad.py').write('def upgrade(engine:\n')
+
+    with pytest.raises(RevisionLoadException):
+        get_upgrade_path(str(tmpdir))
+
+
+@pytest.mark.unit
+def test_revision_check_does_not_import(tmpdir):
+    import sys
+    from tomb_migrate.utils import get_upgrade_path
+    from tomb_migrate.utils import RevisionLoadException
+
+    tmpdir.join('00001_bad.py').write('def upgrade(engine:\n')
+
+    revision = get_upgrade_path(str(tmpdir), load=False)[0]
+    with pytest.raises(RevisionLoadException):
+        revision.check()
+
+    assert revision.filename not in sys.modules
+
+
+@pytest.mark.unit
+def test_psyco_timeouts_from_strings():
+    from tomb_migrate.utils import PsycoDBContainer
+
+    with mock.patch('tomb_migrate.utils.psycopg2.connect') as connect:
+        with mock.patch('tomb_migrate.utils.register_default_jsonb'):
+            PsycoDBContainer('auth', {
+                'type': 'postgresql',
+                'host': '127.0.0.1',
+                'database': 'sontek',
+                'connect_timeout': '5',
+                'statement_timeout': '0.5',
+            }).open()
+
+    kwargs = connect.call_args[1]
+    assert kwargs['connect_timeout'] == 5
+    assert kwargs['options'] == '-c statement_timeout=500'
+
+
+def make_lag_container(replicas, server_version=100000):
+    container, conn, curs = make_psyco_container(0)
+    conn.server_version = server_version
+    curs.fetchall.return_value = replicas
+    return container
+
+
+@pytest.mark.unit
+def test_psyco_replication_lag():
+    container = make_lag_container([('streaming', 1.5), ('streaming', 3)])
+
+    assert container.replication_lag() == 3
+
+
+@pytest.mark.unit
+def test_psyco_replication_lag_without_replicas():
+    container = make_lag_container([])
+
+    assert container.replication_lag() == 0
+
+
+@pytest.mark.unit
+def test_psyco_replication_lag_caught_up():
+    container = make_lag_container([('streaming', None)])
+
+    assert container.replication_lag() == 0
+
+
+@pytest.mark.unit
+def test_psyco_replication_lag_without_privileges():
+    from tomb_migrate.utils import ReplicationLagUnknownException
+
+    container = make_lag_container([(None, None)])
+
+    with pytest.raises(ReplicationLagUnknownException):
+        container.replication_lag()
+
+
+@pytest.mark.unit
+def test_psyco_replication_lag_old_server():
+    from tomb_migrate.utils import ReplicationLagUnknownException
+
+    container = make_lag_container([], server_version=90600)
+
+    with pytest.raises(ReplicationLagUnknownException):
+        container.replication_lag()
+
+
+@pytest.mark.unit
+def test_throttle_fails_before_first_batch():
+    from tomb_migrate.utils import Throttle
+    from tomb_migrate.utils import ReplicationLagUnknownException
+
+    engine = mock.Mock()
+    engine.replication_lag.side_effect = ReplicationLagUnknownException()
+    func = mock.Mock()
+
+    with pytest.raises(ReplicationLagUnknownException):
+        Throttle(engine).run(func)
+
+    assert not func.called
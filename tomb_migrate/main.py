@@ -1,16 +1,25 @@
 import click
+import gc
 import os
 import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 from tomb_migrate.utils import get_databases_from_settings
 from tomb_migrate.utils import get_upgrade_path, get_downgrade_path
 from tomb_migrate.utils import create_new_revision
+from tomb_migrate.utils import iter_revisions
 
 from tomb_migrate.utils import (
     AlreadyInitializedException,
+    DatabaseParkedException,
     NoMigrationsFoundException,
     NotInitializedException,
+    RevisionExistsException,
+    RevisionLoadException,
     UnknownDatabaseType,
+    UnknownRevisionTemplate,
 )
 
 
@@ -18,6 +27,62 @@ def error_msg(msg):
     click.echo(click.style(msg, fg='red', bold=True))
 
 
+def current_rss():
+    """
+    Resident memory of this process right now in megabytes, None where
+    `/proc` is not available.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def peak_rss():
+    """
+    Peak resident memory over the whole life of this process in megabytes,
+    None on platforms without the `resource` module.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, OS X reports bytes
+    if sys.platform == 'darwin':
+        peak = peak / 1024
+
+    return peak / 1024
+
+
+def format_mb(mb, fmt='%.1f MB'):
+    if mb is None:
+        return 'n/a'
+
+    return fmt % mb
+
+
+def report_parked(engines):
+    """
+    Print the databases that were given up on during the run and exit with
+    an error if there were any.
+    """
+    parked = [e for e in engines.values() if e.parked]
+
+    if not parked:
+        return
+
+    for engine in parked:
+        error_msg('%s was parked: %s' % (engine, engine.error))
+
+    sys.exit(1)
+
+
 @click.group(context_settings={'help_option_names': ['-h', '--help']})
 @click.option(
     '--path', '-p',
@@ -40,14 +105,170 @@ def db(ctx, path):
     ctx.obj.db_path = os.path.abspath(path)
 
 
+def upgrade_engine(engine, upgrade_path):
+    """
+    Runs every pending revision on a single database. Returns how long each
+    revision that ran took.
+    """
+    timings = []
+
+    engine.open()
+    if engine.parked:
+        return timings
+
+    revision = None
+    try:
+        current_version = engine.call(engine.current_version)
+        if current_version is None:
+            raise NotInitializedException()
+
+        for revision in upgrade_path:
+            if current_version >= revision.version:
+                msg = "%s already on %s, skipping" % (
+                    engine, revision.version
+                )
+                click.echo(click.style(msg, fg='yellow'))
+                continue
+
+            click.echo('Running upgrade %s on %s' % (revision, engine))
+            start = time.monotonic()
+            # A revision may commit part of its work and only the marker
+            # update commits the rest, so neither is retried on its own.
+            # A failure from here on parks the database instead.
+            revision.upgrade(engine)
+            engine.update(revision.version)
+            timings.append((revision, time.monotonic() - start))
+            current_version = revision.version
+    except DatabaseParkedException:
+        pass
+    except NotInitializedException as e:
+        msg = (
+            "Upgraded was not completed!, Looks like %s has not been "
+            "initialized. Run `tomb init`"
+        ) % engine.name
+        error_msg(msg)
+        engine.park(e)
+    except Exception as e:
+        error_msg('Upgrade %s failed on %s' % (revision, engine))
+        engine.park(e)
+
+    return timings
+
+
+def upgrade_wave(engines, upgrade_path, jobs):
+    """
+    Upgrades a group of databases, `jobs` of them at the same time. Returns
+    the timings of every revision that ran as `(engine, revision, seconds)`.
+    """
+    timings = []
+
+    def run(engine):
+        return engine, upgrade_engine(engine, upgrade_path)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for engine, engine_timings in executor.map(run, engines):
+            for revision, seconds in engine_timings:
+                timings.append((engine, revision, seconds))
+
+    return timings
+
+
+def rollout(engines, upgrade_path, wave_size, jobs, canary_timeout):
+    """
+    Upgrades the canary databases first and stops if any of them failed or
+    was too slow, then upgrades the rest of them in waves.
+    """
+    canaries = [e for e in engines.values() if e.settings.get('canary')]
+    fleet = [e for e in engines.values() if not e.settings.get('canary')]
+
+    if canary_timeout is not None and not canaries:
+        error_msg(
+            '--canary-timeout was given but no database has `canary: true`'
+        )
+        sys.exit(1)
+
+    if canaries:
+        click.echo('Upgrading %s canary databases' % len(canaries))
+        timings = upgrade_wave(canaries, upgrade_path, jobs)
+
+        for engine, revision, seconds in timings:
+            click.echo('%s took %.2fs on %s' % (revision, seconds, engine))
+
+        if any(e.parked for e in canaries):
+            error_msg('Canary upgrade failed, stopping rollout')
+            report_parked(engines)
+
+        slow = [
+            (engine, revision, seconds)
+            for engine, revision, seconds in timings
+            if canary_timeout is not None and seconds > canary_timeout
+        ]
+
+        if slow:
+            for engine, revision, seconds in slow:
+                error_msg(
+                    '%s took %.2fs on %s, over the %.2fs limit' % (
+                        revision, seconds, engine, canary_timeout
+                    )
+                )
+            error_msg('Canary upgrade too slow, stopping rollout')
+            sys.exit(1)
+
+    size = wave_size or len(fleet) or 1
+    for i in range(0, len(fleet), size):
+        wave = fleet[i:i + size]
+        if wave_size:
+            click.echo('Upgrading wave %s (%s databases)' % (
+                i // size + 1, len(wave)
+            ))
+        upgrade_wave(wave, upgrade_path, jobs)
+
+
 @db.command()
+@click.option(
+    '--wave-size', '-w',
+    type=click.IntRange(min=0),
+    default=0,
+    help='How many databases to upgrade per wave, 0 means all at once'
+)
+@click.option(
+    '--jobs', '-j',
+    type=click.IntRange(min=1),
+    default=1,
+    help='How many databases to upgrade at the same time within a wave'
+)
+@click.option(
+    '--canary-timeout',
+    type=click.FloatRange(min=0),
+    default=None,
+    help='Stop the rollout if a revision takes longer than this many '
+         'seconds on a canary database'
+)
+@click.option(
+    '--stream',
+    is_flag=True,
+    default=False,
+    help='Load one revision at a time and apply it everywhere before '
+         'loading the next one'
+)
 @click.pass_context
-def upgrade(ctx):
+def upgrade(ctx, wave_size, jobs, canary_timeout, stream):
     """
     Upgrade the database to revision
+
+    Databases with `canary: true` in their settings are upgraded first, the
+    rest of them only when every canary succeeded within `--canary-timeout`.
+
+    With `--stream` only the revision being applied is kept in memory, which
+    keeps memory flat for very long migration histories.
     """
     try:
-        upgrade_path = get_upgrade_path(ctx.obj.db_path)
+        # Outside of stream mode every revision is imported here, before
+        # any database is touched and before the rollout starts threads.
+        upgrade_path = get_upgrade_path(ctx.obj.db_path, load=not stream)
+        if stream:
+            for revision in upgrade_path:
+                revision.check()
     except NoMigrationsFoundException:
         click.echo(
             "Did not find any migrations to run in %s" % ctx.obj.db_path
@@ -56,28 +277,41 @@ def upgrade(ctx):
             "Have you tried running `tomb db revision -m <description>`?"
         )
         sys.exit(1)
+    except RevisionLoadException as e:
+        error_msg("Could not load revision %s" % str(e))
+        sys.exit(1)
 
-    for revision in upgrade_path:
-        for name, engine in ctx.obj.db_engines.items():
-            current_version = engine.current_version()
-            if current_version >= revision.version:
-                msg = "%s already on %s, skipping" % (engine, revision.version)
-                click.echo(click.style(msg, fg='yellow'))
-                continue
+    engines = ctx.obj.db_engines
 
-            click.echo('Running upgrade %s on %s' % (revision, engine))
+    if stream:
+        rss = current_rss()
+        try:
+            for revision in iter_revisions(upgrade_path):
+                rollout(engines, [revision], wave_size, jobs, canary_timeout)
 
-            try:
-                revision.upgrade(engine)
-                engine.update(revision.version)
-            except NotInitializedException:
-                msg = (
-                    "Upgraded was not completed!, Looks like %s has not been "
-                    "initialized. Run `tomb init`"
-                ) % name
-                error_msg(msg)
-                sys.exit(1)
+                # Measure once the revision is released, module globals and
+                # their functions form cycles only the collector frees.
+                revision.unload()
+                gc.collect()
 
+                before, rss = rss, current_rss()
+                delta = None
+                if before is not None and rss is not None:
+                    delta = rss - before
+
+                click.echo('Memory after %s: %s resident (%s), %s peak' % (
+                    revision,
+                    format_mb(rss),
+                    format_mb(delta, '%+.1f MB'),
+                    format_mb(peak_rss()),
+                ))
+        except RevisionLoadException as e:
+            error_msg("Could not load revision %s" % str(e))
+            sys.exit(1)
+    else:
+        rollout(engines, upgrade_path, wave_size, jobs, canary_timeout)
+
+    report_parked(engines)
     click.echo('Done upgrading')
 
 
@@ -97,36 +331,83 @@ def downgrade(ctx):
             "Have you tried running `tomb db revision -m <description>`?"
         )
         sys.exit(1)
+    except RevisionLoadException as e:
+        error_msg("Could not load revision %s" % str(e))
+        sys.exit(1)
 
     for revision in downgrade_path:
         for name, engine in ctx.obj.db_engines.items():
-            current_version = engine.current_version()
-            if current_version <= revision.version:
-                msg = "%s already on %s, skipping" % (engine, revision.version)
-                click.echo(click.style(msg, fg='yellow'))
+            engine.open()
+            if engine.parked:
                 continue
 
-            click.echo('Running downgrade %s' % revision)
-            revision.upgrade(engine)
-            engine.update(revision.version - 1)
+            try:
+                current_version = engine.call(engine.current_version)
+                if current_version is None:
+                    raise NotInitializedException()
+
+                if current_version <= revision.version:
+                    msg = "%s already on %s, skipping" % (
+                        engine, revision.version
+                    )
+                    click.echo(click.style(msg, fg='yellow'))
+                    continue
 
+                click.echo('Running downgrade %s' % revision)
+                revision.upgrade(engine)
+                engine.update(revision.version - 1)
+            except DatabaseParkedException:
+                continue
+            except Exception as e:
+                error_msg('Downgrade %s failed on %s' % (revision, engine))
+                engine.park(e)
+
+    report_parked(ctx.obj.db_engines)
     click.echo('Done downgrading')
 
 
+def init_engine(engine):
+    """
+    Initialize a single database, returns the message to report for it.
+    """
+    engine.open()
+    if engine.parked:
+        return 'Connecting to %s failed' % engine
+
+    try:
+        engine.call(engine.init)
+    except AlreadyInitializedException:
+        return '%s is already initialized' % engine
+    except DatabaseParkedException:
+        return '%s is parked, skipping' % engine
+    except Exception as e:
+        engine.park(e)
+        return 'Initializing %s failed' % engine
+
+    return 'Initialized %s' % engine
+
+
 @db.command()
+@click.option(
+    '--jobs', '-j',
+    type=click.IntRange(min=1),
+    default=8,
+    help='How many databases to initialize at the same time'
+)
 @click.pass_context
-def init(ctx):
+def init(ctx, jobs):
     """
     Create initial tracking tables for tomb_migrate
     """
     engines = ctx.obj.db_engines
-    for key, engine in engines.items():
-        click.echo('Initializing %s' % engine)
-        try:
-            engine.init()
-        except AlreadyInitializedException:
-            click.echo('%s is already initialized' % engine)
+    pending = [e for e in engines.values() if not e.parked]
 
+    click.echo('Initializing %s databases' % len(pending))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for msg in executor.map(init_engine, pending):
+            click.echo(msg)
+
+    report_parked(engines)
     click.echo("done initializing databases")
 
 
@@ -136,11 +417,23 @@ def init(ctx):
     help='Short description about the revision',
     required=True
 )
+@click.option(
+    '--template', '-t',
+    default='default',
+    help='Name of the revision template to use, e.g. the database type'
+)
 @click.pass_context
-def revision(ctx, message):
+def revision(ctx, message, template):
     """
     Generates a new revision file
     """
-    fname = create_new_revision(ctx.obj.db_path, message)
+    try:
+        fname = create_new_revision(ctx.obj.db_path, message, template)
+    except UnknownRevisionTemplate as e:
+        error_msg("Unknown revision template: %s" % str(e))
+        sys.exit(1)
+    except RevisionExistsException as e:
+        error_msg("Revision file already exists: %s" % str(e))
+        sys.exit(1)
 
     click.echo('Created new revision file at %s' % fname)
@@ -4,6 +4,8 @@ from importlib.machinery import SourceFileLoader
 from functools import partial
 from datetime import datetime
 from abc import ABCMeta, abstractmethod
+import sys
+import time
 
 # TODO: This should be optional dependency
 import psycopg2
@@ -17,10 +19,21 @@ from psycopg2.extras import Json as pjson
 Json = partial(pjson, dumps=rapidjson.dumps)
 UTC = pytz.utc
 MARKER_TABLE_NAME = 'tomb_migrate_version'
+DEFAULT_VERSION_WIDTH = 4
+DEFAULT_REVISION_TEMPLATE = """\
+import click
+
+def upgrade(engine):
+    click.echo('Run upgrade!')
+
+def downgrade(engine):
+    click.echo('Run downgrade!')
+"""
 
 
 class NotInitializedException(Exception):
-    pass
+    def __init__(self, msg='not initialized, run `tomb db init`'):
+        super().__init__(msg)
 
 
 class AlreadyInitializedException(Exception):
@@ -39,6 +52,26 @@ class UnknownDatabaseType(Exception):
     pass
 
 
+class DatabaseParkedException(Exception):
+    pass
+
+
+class UnknownRevisionTemplate(Exception):
+    pass
+
+
+class RevisionExistsException(Exception):
+    pass
+
+
+class RevisionLoadException(Exception):
+    pass
+
+
+class ReplicationLagUnknownException(Exception):
+    pass
+
+
 def utc_now():
     now = datetime.utcnow()
     tz_now = now.replace(tzinfo=UTC)
@@ -60,13 +93,100 @@ def get_revision_from_name(filename):
 
 
 class BaseDatabaseContainer:
+    """
+    Wraps a single configured database.
+
+    Besides the connection settings every database accepts an optional
+    policy that controls how hard we try before giving up on it:
+
+    .. code-block:: python
+
+        {
+            'connect_timeout': 5,      # seconds
+            'statement_timeout': 300,  # seconds, postgresql only
+            'retries': 3,              # retries on transient errors
+            'retry_backoff': 0.5,      # seconds, doubled on every retry
+        }
+
+    Once the retries are exhausted the database gets parked, every later
+    call raises :class:`DatabaseParkedException` so the rest of the fleet
+    can keep going.
+    """
     __metaclass__ = ABCMeta
 
+    # Errors that are worth retrying, provided by each backend
+    transient_errors = ()
+
     def __init__(self, name, settings):
         self.name = name
         self.settings = settings
         self.type = settings['type']
         self.host = settings['host']
+        self.connect_timeout = None
+        self.statement_timeout = None
+        if settings.get('connect_timeout') is not None:
+            self.connect_timeout = float(settings['connect_timeout'])
+        if settings.get('statement_timeout') is not None:
+            self.statement_timeout = float(settings['statement_timeout'])
+        self.retries = int(settings.get('retries', 0))
+        self.retry_backoff = float(settings.get('retry_backoff', 0.5))
+        self.conn = None
+        self.parked = False
+        self.error = None
+
+    def park(self, error):
+        """
+        Stop running anything against this database for the rest of the run.
+        """
+        self.parked = True
+        self.error = error
+
+    def call(self, func, *args, **kwargs):
+        """
+        Runs `func` with the retry policy of this database. Transient errors
+        are retried with an exponential backoff, when they keep happening
+        the database is parked and the last error is raised.
+        """
+        if self.parked:
+            raise DatabaseParkedException(self.name)
+
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                if attempt:
+                    self.reset()
+                return func(*args, **kwargs)
+            except self.transient_errors as e:
+                error = e
+                if attempt < self.retries:
+                    time.sleep(self.retry_backoff * 2 ** attempt)
+
+        self.park(error)
+        raise error
+
+    def open(self):
+        """
+        Connects on first use, so the connections to many databases can be
+        opened concurrently. A database that cannot be reached gets parked,
+        the caller reports it.
+        """
+        if self.conn is not None or self.parked:
+            return
+
+        try:
+            self.conn = self.call(self.connect)
+        except Exception as e:
+            self.park(e)
+
+    def reset(self):
+        """
+        Get the connection back into a usable state before a retry.
+        """
+        pass
+
+    @abstractmethod
+    def connect(self):
+        raise NotImplementedError()
 
     @abstractmethod
     def init(self):
@@ -80,6 +200,13 @@ class BaseDatabaseContainer:
     def current_version(self):
         raise NotImplementedError()
 
+    def replication_lag(self):
+        """
+        How many seconds the replicas are behind, used by :class:`Throttle`.
+        Backends that know nothing about their replicas report no lag.
+        """
+        return 0.0
+
     def __unicode__(self):
         return '%s (%s)' % (self.name, self.host)
 
@@ -87,12 +214,15 @@ class BaseDatabaseContainer:
 
 
 class RethinkDBContainer(BaseDatabaseContainer):
-    def __init__(self, name, settings):
-        super().__init__(name, settings)
+    transient_errors = (
+        rethinkdb.errors.ReqlDriverError,
+        rethinkdb.errors.ReqlAvailabilityError,
+    )
 
+    def connect(self):
         kwargs = {
-            'host': settings['host'],
-            'db': settings['database'],
+            'host': self.settings['host'],
+            'db': self.settings['database'],
         }
 
         optional_keys = [
@@ -100,22 +230,42 @@ class RethinkDBContainer(BaseDatabaseContainer):
         ]
 
         for key in optional_keys:
-            if key in settings:
-                kwargs[key] = settings[key]
+            if key in self.settings:
+                kwargs[key] = self.settings[key]
 
-        self.conn = rethinkdb.connect(**kwargs)
+        if self.connect_timeout is not None:
+            kwargs['timeout'] = self.connect_timeout
 
-    def init(self):
-        current_version = self.current_version()
+        return rethinkdb.connect(**kwargs)
 
-        if current_version is not None:
-            raise AlreadyInitializedException()
+    def reset(self):
+        if self.conn is not None:
+            self.conn.reconnect(noreply_wait=False)
 
-        rethinkdb.table_create(MARKER_TABLE_NAME).run(self.conn)
-        rethinkdb.table(MARKER_TABLE_NAME).insert({
+    def init(self):
+        """
+        Creates the marker table and its row if they are missing, the
+        existence checks happen on the server so this is a single round trip.
+        """
+        marker = rethinkdb.table(MARKER_TABLE_NAME)
+        insert = marker.insert({
             'version': 0,
             'date_updated': utc_now(),
-        }).run(self.conn)
+        })
+        create = rethinkdb.table_create(MARKER_TABLE_NAME).do(
+            lambda _: marker.wait().do(lambda _: insert)
+        )
+
+        result = rethinkdb.branch(
+            rethinkdb.table_list().contains(MARKER_TABLE_NAME).not_(),
+            create,
+            marker.is_empty(),
+            insert,
+            {'inserted': 0},
+        ).run(self.conn)
+
+        if not result['inserted']:
+            raise AlreadyInitializedException()
 
     def update(self, version):
         try:
@@ -143,16 +293,32 @@ class RethinkDBContainer(BaseDatabaseContainer):
                 return None
             raise
 
-        return result[0]['version']
+        return result[0]['version'] if result else None
+
+    def replication_lag(self):
+        """
+        RethinkDB does not expose a lag, so any table in the database whose
+        replicas are not all ready counts as being over every lag budget.
+        """
+        not_ready = rethinkdb.db('rethinkdb').table('table_status').filter({
+            'db': self.settings['database'],
+        }).filter(
+            lambda table: table['status']['all_replicas_ready'].not_()
+        ).count().run(self.conn)
+
+        return float('inf') if not_ready else 0.0
 
 
 class PsycoDBContainer(BaseDatabaseContainer):
-    def __init__(self, name, settings):
-        super().__init__(name, settings)
+    transient_errors = (
+        psycopg2.OperationalError,
+        psycopg2.InterfaceError,
+    )
 
+    def connect(self):
         kwargs = {
-            'host': settings['host'],
-            'database': settings['database'],
+            'host': self.settings['host'],
+            'database': self.settings['database'],
         }
 
         optional_keys = [
@@ -160,39 +326,67 @@ class PsycoDBContainer(BaseDatabaseContainer):
         ]
 
         for key in optional_keys:
-            if key in settings:
-                kwargs[key] = settings[key]
+            if key in self.settings:
+                kwargs[key] = self.settings[key]
+
+        if self.connect_timeout is not None:
+            # libpq only accepts whole seconds
+            kwargs['connect_timeout'] = max(1, int(self.connect_timeout))
+
+        if self.statement_timeout is not None:
+            kwargs['options'] = '-c statement_timeout=%d' % int(
+                self.statement_timeout * 1000
+            )
 
         conn = psycopg2.connect(**kwargs)
         register_default_jsonb(conn, loads=rapidjson.loads)
 
-        self.conn = conn
+        return conn
+
+    def reset(self):
+        if self.conn is None:
+            return
+
+        if self.conn.closed:
+            self.conn = self.connect()
+        else:
+            self.conn.rollback()
 
     def current_version(self):
         select_sql = "SELECT * FROM %s LIMIT 1" % MARKER_TABLE_NAME
 
         with self.conn.cursor() as curs:
-            curs.execute(select_sql)
+            try:
+                curs.execute(select_sql)
+            except psycopg2.ProgrammingError as e:
+                if e.pgcode == "42P01":
+                    self.conn.rollback()
+                    return None
+                raise
+
             result = curs.fetchone()
-            return result[0]
+            return result[0] if result else None
 
     def init(self):
-        create_sql = """CREATE TABLE IF NOT EXISTS %s(
+        """
+        Creates the marker table and its row if they are missing. Both
+        statements are sent together so this is a single round trip.
+        """
+        init_sql = """CREATE TABLE IF NOT EXISTS {0}(
             version int NOT NULL,
-            date_updated timestamp)""" % MARKER_TABLE_NAME
-        insert_sql = """INSERT INTO {0}(version, date_updated)
-                     VALUES(%s, %s)""".format(MARKER_TABLE_NAME)
-
-        current_version = self.current_version()
-
-        if current_version is not None:
-            raise AlreadyInitializedException()
+            date_updated timestamp);
+            INSERT INTO {0}(version, date_updated)
+            SELECT %s, %s
+            WHERE NOT EXISTS (SELECT 1 FROM {0})""".format(MARKER_TABLE_NAME)
 
         with self.conn.cursor() as curs:
-            curs.execute(create_sql)
-            curs.execute(insert_sql, (0, utc_now()))
+            curs.execute(init_sql, (0, utc_now()))
+            inserted = curs.rowcount
             self.conn.commit()
 
+        if not inserted:
+            raise AlreadyInitializedException()
+
     def update(self, version):
         update_sql = """UPDATE {0}
                         SET version=%s,
@@ -207,6 +401,110 @@ class PsycoDBContainer(BaseDatabaseContainer):
                     raise NotInitializedException()
                 raise
 
+    def replication_lag(self):
+        """
+        Needs PostgreSQL 10 or newer and a role that can read the details of
+        `pg_stat_replication` (superuser or `pg_monitor`), otherwise the lag
+        is unknown and :class:`ReplicationLagUnknownException` is raised.
+        """
+        if self.conn.server_version < 100000:
+            raise ReplicationLagUnknownException(
+                "replication lag needs PostgreSQL 10 or newer"
+            )
+
+        lag_sql = """SELECT state, EXTRACT(EPOCH FROM replay_lag)
+                     FROM pg_stat_replication"""
+
+        with self.conn.cursor() as curs:
+            curs.execute(lag_sql)
+            replicas = curs.fetchall()
+
+        # Without the privileges every column but the pid is NULL
+        if any(state is None for state, lag in replicas):
+            raise ReplicationLagUnknownException(
+                "%s is not allowed to read pg_stat_replication, "
+                "grant it pg_monitor" % self.name
+            )
+
+        # Replicas that caught up and went idle report no lag at all
+        lags = [float(lag or 0) for state, lag in replicas]
+        return max(lags) if lags else 0.0
+
+
+class Throttle:
+    """
+    Paces a long running data migration so the replicas can keep up with
+    the primary. `func` is called with the size of the next batch and
+    returns how many rows it processed, the migration is done when it
+    returns 0:
+
+    .. code-block:: python
+
+        def upgrade(engine):
+            throttle = Throttle(engine, max_lag=5)
+            throttle.run(lambda size: backfill_users(engine, size))
+            click.echo('%.0f rows/sec' % throttle.rows_per_second)
+
+    Before every batch the replication lag is polled, the batch shrinks and
+    the pause grows while it is over `max_lag` and they recover once the lag
+    is back under half of it.
+    """
+    def __init__(
+        self, engine, max_lag=5, batch_size=1000, min_batch_size=10,
+        max_batch_size=10000, max_sleep=30
+    ):
+        self.engine = engine
+        self.max_lag = max_lag
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_sleep = max_sleep
+        self.sleep = 0
+        self.rows = 0
+        self.elapsed = 0
+
+    @property
+    def rows_per_second(self):
+        if not self.elapsed:
+            return 0.0
+
+        return self.rows / self.elapsed
+
+    def adjust(self, lag):
+        """
+        Update the batch size and pause for the measured `lag`.
+        """
+        if lag > self.max_lag:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            self.sleep = min(self.max_sleep, max(self.sleep * 2, 0.1))
+        elif lag < self.max_lag / 2:
+            self.batch_size = min(
+                self.max_batch_size, int(self.batch_size * 1.5)
+            )
+            self.sleep = self.sleep / 2 if self.sleep > 0.1 else 0
+
+    def run(self, func):
+        """
+        Call `func` in batches until it runs out of rows, returns the total
+        number of rows processed.
+        """
+        start = time.monotonic()
+
+        while True:
+            # Polled before every batch, so a lag that cannot be read fails
+            # before the first row is written.
+            self.adjust(self.engine.replication_lag())
+
+            if self.sleep:
+                time.sleep(self.sleep)
+
+            processed = func(self.batch_size)
+            self.rows += processed
+            self.elapsed = time.monotonic() - start
+
+            if not processed:
+                return self.rows
+
 
 class Revision:
     def __init__(self, filename):
@@ -214,9 +512,46 @@ class Revision:
         rev, description = get_revision_from_name(filename)
         self.version = rev
         self.description = description
-        module = SourceFileLoader(filename, filename).load_module()
-        self.upgrade = module.upgrade
-        self.downgrade = module.downgrade
+        self.module = None
+
+    def load(self):
+        """
+        Imports the revision file, this only happens on first use.
+        """
+        if self.module is None:
+            loader = SourceFileLoader(self.filename, self.filename)
+            try:
+                self.module = loader.load_module()
+            except Exception as e:
+                raise RevisionLoadException('%s: %s' % (self.filename, e))
+
+        return self.module
+
+    def check(self):
+        """
+        Compiles the revision file without importing it, so syntax errors
+        show up before anything runs.
+        """
+        try:
+            with open(self.filename, 'rb') as revision_file:
+                compile(revision_file.read(), self.filename, 'exec')
+        except (OSError, SyntaxError, ValueError) as e:
+            raise RevisionLoadException('%s: %s' % (self.filename, e))
+
+    def unload(self):
+        """
+        Drops the imported revision file so it can be garbage collected.
+        """
+        self.module = None
+        sys.modules.pop(self.filename, None)
+
+    @property
+    def upgrade(self):
+        return self.load().upgrade
+
+    @property
+    def downgrade(self):
+        return self.load().downgrade
 
     def __repr__(self):
         return '<Revision: version=%s, desc=%s>' % (
@@ -232,10 +567,13 @@ class Revision:
         return r1 == r2
 
 
-def get_files_in_directory(directory):
+def get_files_in_directory(directory, load=True):
     """
     Get all file in a directory, exclude any directories. This will sort by
     revision number.
+
+    Every revision file is imported right away unless `load` is False, then
+    it is only imported on first use.
     """
     if not isdir(directory):
         mkdir(directory)
@@ -246,7 +584,11 @@ def get_files_in_directory(directory):
         if not isfile(path):
             continue
 
-        files.append(Revision(path))
+        revision = Revision(path)
+        if load:
+            revision.load()
+
+        files.append(revision)
 
     if not files:
         raise NoMigrationsFoundException()
@@ -255,14 +597,27 @@ def get_files_in_directory(directory):
     return revisions
 
 
-def get_upgrade_path(directory, version=None):
+def iter_revisions(revisions):
+    """
+    Yields the revisions one at a time, each revision file is only imported
+    for its turn and released again before the next one is loaded.
+    """
+    for revision in revisions:
+        revision.load()
+        try:
+            yield revision
+        finally:
+            revision.unload()
+
+
+def get_upgrade_path(directory, version=None, load=True):
     """
     Loads all the files in the order necessary to upgrade.
 
     Optionals `version` argument if you want to start from
     a certain location.
     """
-    revisions = get_files_in_directory(directory)
+    revisions = get_files_in_directory(directory, load=load)
     if version:
         revisions_to_run = [r for r in revisions if r.version >= version]
     else:
@@ -324,29 +679,58 @@ def get_databases_from_settings(settings):
     return databases
 
 
-def create_new_revision(directory, message):
-    try:
-        current_revisions = get_upgrade_path(directory)
-        current_version = current_revisions[-1].version
-    except NoMigrationsFoundException:
-        current_version = 1
+def get_latest_version(directory):
+    """
+    Finds the highest revision number in a directory and how wide its zero
+    padding is. Only the file names are looked at, nothing gets imported.
+    """
+    if not isdir(directory):
+        mkdir(directory)
 
-    padded_version = "{0:04d}".format(current_version)
-    tmpl = """\
-import click
+    latest = (0, DEFAULT_VERSION_WIDTH)
+    for f in listdir(directory):
+        if not isfile(join(directory, f)):
+            continue
 
-def upgrade(engine):
-    click.echo('Run upgrade!')
+        rev = f.split('_', 1)[0]
+        if not rev.isdigit():
+            continue
 
-def downgrade(engine):
-    click.echo('Run downgrade!')
-"""
+        latest = max(latest, (int(rev), len(rev)))
+
+    return latest
+
+
+def get_revision_template(name):
+    """
+    Loads a revision template registered under `name` in the
+    `tomb_migrate.revision_templates` entry point.
+    """
+    for ep in pkg_resources.iter_entry_points(
+        'tomb_migrate.revision_templates', name
+    ):
+        return ep.load()
+
+    if name == 'default':
+        return DEFAULT_REVISION_TEMPLATE
+
+    raise UnknownRevisionTemplate(name)
+
+
+def create_new_revision(directory, message, template='default'):
+    current_version, width = get_latest_version(directory)
+    tmpl = get_revision_template(template)
+
+    padded_version = str(current_version + 1).zfill(width)
     description = message.replace(' ', '_')
     fname = '%s_%s.py' % (padded_version, description)
 
     path = join(directory, fname)
 
-    with open(path, "w") as revision_file:
-        revision_file.write(tmpl)
+    try:
+        with open(path, "x") as revision_file:
+            revision_file.write(tmpl)
+    except FileExistsError:
+        raise RevisionExistsException(path)
 
     return path